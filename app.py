@@ -1,52 +1,74 @@
 # app.py - HBV Sponsor Outreach Agent (Fully Working - January 2026)
-# Uses correct imports for autogen-agentchat 0.7.5
+# Uses the pyautogen (autogen 0.2-style) agent API
 
 import os
+import re
 import streamlit as st
 import logging
+from logging.handlers import QueueHandler, QueueListener, RotatingFileHandler
+import queue
+import atexit
 import time
 import sqlite3
+import json
 import pandas as pd
 from datetime import datetime
-from functools import wraps
+import threading
+import itertools
+from collections import deque
+from concurrent.futures import ThreadPoolExecutor, as_completed
+from functools import lru_cache
+from urllib.parse import urlparse
 from duckduckgo_search import DDGS
 import smtplib
 from email.mime.text import MIMEText
 from email.mime.multipart import MIMEMultipart
 
 # ====================== CONFIG & LOGGING ======================
-logging.basicConfig(
-    filename='hbv_outreach.log',
-    level=logging.INFO,
-    format='%(asctime)s - %(levelname)s - %(message)s',
-    filemode='a'
-)
+LOG_FILE = "hbv_outreach.log"
+
+# File I/O happens on a QueueListener thread so logging never blocks the send loop.
+# Streamlit reruns this script, so only configure once per process.
+if not logging.getLogger().handlers:
+    _log_queue = queue.Queue(-1)
+    _log_file_handler = RotatingFileHandler(LOG_FILE, maxBytes=1_000_000, backupCount=3)
+    _log_file_handler.setFormatter(logging.Formatter('%(asctime)s - %(levelname)s - %(message)s'))
+    logging.basicConfig(handlers=[QueueHandler(_log_queue)], level=logging.INFO)
+    _log_listener = QueueListener(_log_queue, _log_file_handler)
+    _log_listener.start()
+    atexit.register(_log_listener.stop)
 
 def log_action(action: str, details: str = ""):
     logging.info(f"{action} | {details}")
 
-# Rate limiting for emails
-def rate_limit(seconds_between_emails: int = 5):
-    last_called = 0
-    def decorator(func):
-        @wraps(func)
-        def wrapper(*args, **kwargs):
-            nonlocal last_called
-            elapsed = time.time() - last_called
-            if elapsed < seconds_between_emails:
-                time.sleep(seconds_between_emails - elapsed)
-            result = func(*args, **kwargs)
-            last_called = time.time()
-            return result
-        return wrapper
-    return decorator
-
 # ====================== DATABASE ======================
 DB_FILE = "sponsors.db"
 
+PRIORITY_KEYWORDS = {
+    **{kw: 20 for kw in ["hepatitis b", "hbv", "liver", "transplant", "nigeria", "africa", "grant", "sponsor"]},
+    **{kw: 8 for kw in ["medical", "health", "christian", "charity", "donation", "ngo"]},
+}
+# Each `in` check is a C-level substring search; a regex alternation benchmarked ~5x slower
+_PRIORITY_ITEMS = tuple(PRIORITY_KEYWORDS.items())
+
+@lru_cache(maxsize=4096)
+def calculate_priority(description: str) -> int:
+    desc = description.lower()
+    return min(sum(weight for kw, weight in _PRIORITY_ITEMS if kw in desc), 100)
+
+def connect_db(**kwargs) -> sqlite3.Connection:
+    # Use for every writer: the sponsors priority triggers call calc_priority, and
+    # synchronous=NORMAL (safe under WAL) is a per-connection setting
+    conn = sqlite3.connect(DB_FILE, **kwargs)
+    conn.execute("PRAGMA synchronous=NORMAL")
+    conn.create_function("calc_priority", 1, calculate_priority, deterministic=True)
+    return conn
+
 def init_db():
-    conn = sqlite3.connect(DB_FILE)
+    conn = connect_db()
     c = conn.cursor()
+    # WAL is persistent in the db file, so setting it once here is enough
+    c.execute("PRAGMA journal_mode=WAL")
     c.execute('''CREATE TABLE IF NOT EXISTS sponsors (
                  id INTEGER PRIMARY KEY AUTOINCREMENT,
                  name TEXT, email TEXT UNIQUE, description TEXT, source TEXT,
@@ -55,12 +77,115 @@ def init_db():
                  id INTEGER PRIMARY KEY AUTOINCREMENT,
                  sponsor_id INTEGER, sent_date TEXT, status TEXT, message TEXT,
                  FOREIGN KEY(sponsor_id) REFERENCES sponsors(id))''')
+    c.execute('''CREATE TABLE IF NOT EXISTS search_cache (
+                 query TEXT, max_results INTEGER, ts INTEGER, payload TEXT,
+                 PRIMARY KEY(query, max_results))''')
+    # Indexes for the Tab 3 pending query (anti-join + priority sort)
+    c.execute("CREATE INDEX IF NOT EXISTS idx_outreach_sponsor ON outreach(sponsor_id)")
+    c.execute("CREATE INDEX IF NOT EXISTS idx_sponsors_priority ON sponsors(priority DESC)")
+    # Email lookups already use the UNIQUE constraint's autoindex; drop the old duplicate
+    c.execute("DROP INDEX IF EXISTS idx_sponsors_email")
+    # Sponsors without an email are de-duplicated on their name instead
+    if not c.execute("SELECT 1 FROM sqlite_master WHERE name = 'idx_sponsors_name_no_email'").fetchone():
+        c.execute('''DELETE FROM sponsors WHERE email IS NULL AND id NOT IN (
+                     SELECT MIN(id) FROM sponsors WHERE email IS NULL GROUP BY lower(name))''')
+        c.execute("CREATE UNIQUE INDEX idx_sponsors_name_no_email ON sponsors(lower(name)) WHERE email IS NULL")
+    # Full-text index over sponsor descriptions, kept in sync by triggers
+    fts_exists = c.execute("SELECT 1 FROM sqlite_master WHERE name = 'sponsors_fts'").fetchone()
+    c.execute("CREATE VIRTUAL TABLE IF NOT EXISTS sponsors_fts USING fts5(description, content='sponsors', content_rowid='id')")
+    c.execute('''CREATE TRIGGER IF NOT EXISTS sponsors_fts_ai AFTER INSERT ON sponsors BEGIN
+                 INSERT INTO sponsors_fts(rowid, description) VALUES (new.id, new.description);
+                 END''')
+    c.execute('''CREATE TRIGGER IF NOT EXISTS sponsors_fts_ad AFTER DELETE ON sponsors BEGIN
+                 INSERT INTO sponsors_fts(sponsors_fts, rowid, description) VALUES ('delete', old.id, old.description);
+                 END''')
+    c.execute('''CREATE TRIGGER IF NOT EXISTS sponsors_fts_au AFTER UPDATE OF description ON sponsors BEGIN
+                 INSERT INTO sponsors_fts(sponsors_fts, rowid, description) VALUES ('delete', old.id, old.description);
+                 INSERT INTO sponsors_fts(rowid, description) VALUES (new.id, new.description);
+                 END''')
+    if not fts_exists:
+        c.execute("INSERT INTO sponsors_fts(sponsors_fts) VALUES ('rebuild')")
+    # Priority is derived from description inside SQLite, so writers never score rows themselves
+    c.execute('''CREATE TRIGGER IF NOT EXISTS trg_sponsor_priority_ai AFTER INSERT ON sponsors BEGIN
+                 UPDATE sponsors SET priority = calc_priority(COALESCE(new.description, '')) WHERE id = new.id;
+                 END''')
+    c.execute('''CREATE TRIGGER IF NOT EXISTS trg_sponsor_priority_au AFTER UPDATE OF description ON sponsors BEGIN
+                 UPDATE sponsors SET priority = calc_priority(COALESCE(new.description, '')) WHERE id = new.id;
+                 END''')
     conn.commit()
     conn.close()
     log_action("Database initialized")
 
 init_db()
 
+def file_signature(*paths) -> tuple:
+    # (mtime, size) per file; with WAL, fresh writes land in the -wal file first
+    return tuple((os.stat(p).st_mtime_ns, os.stat(p).st_size) if os.path.exists(p) else None for p in paths)
+
+def db_signature() -> tuple:
+    return file_signature(DB_FILE, DB_FILE + "-wal")
+
+@st.cache_data(ttl=60)
+def load_sponsors(sig: tuple) -> pd.DataFrame:
+    conn = sqlite3.connect(DB_FILE)
+    df = pd.read_sql_query("SELECT * FROM sponsors ORDER BY priority DESC", conn)
+    conn.close()
+    return df
+
+PENDING_SQL = """
+    SELECT s.id, s.name, s.email, s.priority
+    FROM sponsors s
+    WHERE NOT EXISTS (SELECT 1 FROM outreach o WHERE o.sponsor_id = s.id)
+      AND s.email IS NOT NULL AND instr(s.email, '@') > 0
+    ORDER BY s.priority DESC
+"""
+
+OUTREACH_INSERT_SQL = "INSERT INTO outreach (sponsor_id, sent_date, status, message) VALUES (?, ?, ?, ?)"
+OUTREACH_FLUSH_EVERY = 50
+
+def flush_outreach(cur: sqlite3.Cursor, rows: list) -> None:
+    # Connection is in autocommit mode (isolation_level=None); BEGIN IMMEDIATE
+    # takes the write lock up front so the flush can't fail on a lock upgrade
+    if not rows:
+        return
+    cur.execute("BEGIN IMMEDIATE")
+    try:
+        cur.executemany(OUTREACH_INSERT_SQL, rows)
+    except Exception:
+        cur.execute("ROLLBACK")
+        raise
+    cur.execute("COMMIT")
+    rows.clear()
+
+def drain_outreach(completed: queue.Queue) -> list:
+    # Turn everything send_batch has finished so far into outreach rows
+    rows = []
+    while True:
+        try:
+            sponsor_id, _, status, sent_date = completed.get_nowait()
+        except queue.Empty:
+            return rows
+        rows.append((sponsor_id, sent_date, status, "HTML template"))
+
+@st.cache_data(ttl=60)
+def load_pending(sig: tuple) -> pd.DataFrame:
+    conn = sqlite3.connect(DB_FILE)
+    pending = pd.read_sql_query(PENDING_SQL, conn)
+    conn.close()
+    return pending
+
+@st.cache_data(ttl=60)
+def load_log_tail(sig: tuple, lines: int = 50, window: int = 8192) -> list:
+    # Only read the end of the file; the first line may be cut off mid-way
+    with open(LOG_FILE, "rb") as f:
+        f.seek(0, os.SEEK_END)
+        size = f.tell()
+        f.seek(max(0, size - window))
+        tail = f.read().decode(errors="ignore").splitlines()
+    if size > window:
+        tail = tail[1:]
+    return tail[-lines:]
+
 # ====================== EMAIL TEMPLATE ======================
 HTML_TEMPLATE = """\
 <html>
@@ -91,25 +216,202 @@ HTML_TEMPLATE = """\
   </body>
 </html>
 """
+# Split once so the send loop concatenates instead of re-parsing with .format()
+_TEMPLATE_HEAD, _TEMPLATE_TAIL = HTML_TEMPLATE.split("{recipient_name_or_team}")
 
 # ====================== TOOLS ======================
-def web_search(query: str, max_results: int = 15) -> str:
+SEARCH_CACHE_TTL = 3600  # seconds
+SNIPPET_CHARS = 300
+MAX_SUBQUERIES = 5
+
+# One DDGS client per thread, kept across Streamlit reruns, so repeat searches
+# reuse the open HTTP connection instead of a new TCP+TLS handshake.
+# Per-thread rather than shared-with-a-lock so web_search_multi stays parallel.
+@st.cache_resource
+def _ddgs_local() -> threading.local:
+    return threading.local()
+
+@st.cache_resource
+def _search_executor() -> ThreadPoolExecutor:
+    return ThreadPoolExecutor(max_workers=MAX_SUBQUERIES)
+
+def _ddgs() -> DDGS:
+    local = _ddgs_local()
+    ddgs = getattr(local, "client", None)
+    if ddgs is None:
+        ddgs = local.client = DDGS()
+    return ddgs
+
+@lru_cache(maxsize=256)
+def _search_results(query: str, max_results: int, ttl_bucket: int) -> list:
+    # ttl_bucket only varies the in-process cache key so entries expire with the TTL
+    now = int(time.time())
+    conn = connect_db()
     try:
-        with DDGS() as ddgs:
-            results = list(ddgs.text(query, max_results=max_results))
-        if not results:
-            return "No results found."
-        formatted = "\n\n".join([
-            f"Title: {r['title']}\nLink: {r['href']}\nSnippet: {r['body']}"
-            for r in results
-        ])
-        return formatted
+        row = conn.execute("SELECT payload FROM search_cache WHERE query = ? AND max_results = ? AND ts > ?",
+                           (query, max_results, now - SEARCH_CACHE_TTL)).fetchone()
+        if row:
+            return json.loads(row[0])
+        results = [
+            {"title": r["title"], "href": r["href"], "body": r["body"][:SNIPPET_CHARS]}
+            for r in itertools.islice(_ddgs().text(query, max_results=max_results), max_results)
+        ]
+        with conn:
+            # Drop expired entries for every query so the table stays bounded
+            conn.execute("DELETE FROM search_cache WHERE ts <= ?", (now - SEARCH_CACHE_TTL,))
+            conn.execute("INSERT OR REPLACE INTO search_cache (query, max_results, ts, payload) VALUES (?, ?, ?, ?)",
+                         (query, max_results, now, json.dumps(results)))
+        return results
+    finally:
+        conn.close()
+
+def _rank_results(results: list) -> list:
+    # Cheap keyword prefilter before the text reaches the LLM: best score first
+    # (DDG order breaks ties), one hit per domain, zero-score hits dropped
+    # unless nothing scored at all
+    scored = sorted(
+        ((calculate_priority(f"{r['title']} {r['body']}"), i, r) for i, r in enumerate(results)),
+        key=lambda t: (-t[0], t[1]),
+    )
+    if scored and scored[0][0] > 0:
+        scored = [t for t in scored if t[0] > 0]
+    seen_domains = set()
+    ranked = []
+    for _, _, r in scored:
+        domain = urlparse(r["href"]).netloc.lower().removeprefix("www.")
+        if domain in seen_domains:
+            continue
+        seen_domains.add(domain)
+        ranked.append(r)
+    return ranked
+
+SEARCH_OUTPUT_CHARS = 6000
+
+def _format_results(results: list, max_chars: int) -> str:
+    buf = []
+    used = 0
+    for r in _rank_results(results):
+        entry = f"Title: {r['title']}\nLink: {r['href']}\nSnippet: {r['body'][:SNIPPET_CHARS]}"
+        used += len(entry) + 2
+        if buf and used > max_chars:
+            break
+        buf.append(entry)
+    return "\n\n".join(buf) if buf else "No results found."
+
+def _fetch_results(query: str, max_results: int) -> list:
+    return _search_results(query.strip(), max_results, int(time.time() // SEARCH_CACHE_TTL))
+
+def web_search(query: str, max_results: int = 15, max_chars: int = SEARCH_OUTPUT_CHARS) -> str:
+    try:
+        return _format_results(_fetch_results(query, max_results), max_chars)
     except Exception as e:
         return f"Search error: {str(e)}"
 
-@rate_limit(seconds_between_emails=5)
-def send_email(to_email: str, subject: str, body_html: str, from_email: str,
-               smtp_server: str, smtp_port: int, username: str, password: str) -> str:
+def web_search_multi(queries: list[str], max_results: int = 10) -> str:
+    # Sub-queries are network-bound, so fetch them side by side, then rank,
+    # dedupe by domain and cap the merged results once
+    queries = [q for q in queries if q.strip()][:MAX_SUBQUERIES]
+    if not queries:
+        return "No results found."
+    futures = [_search_executor().submit(_fetch_results, q, max_results) for q in queries]
+    results, errors = [], []
+    for q, future in zip(queries, futures):
+        try:
+            results.extend(future.result())
+        except Exception as e:
+            errors.append(f"Search error for {q!r}: {str(e)}")
+    if errors and not results:
+        return "\n".join(errors)
+    return "\n\n".join(errors + [_format_results(results, SEARCH_OUTPUT_CHARS)])
+
+class RateGate:
+    """Allows at most `limit` events in any `delta`-second window.
+
+    Uses the monotonic clock, so wall-clock (NTP) jumps can't stall or burst sends.
+    """
+    __slots__ = ("delta", "limit", "_times")
+
+    def __init__(self, delta: float, limit: int):
+        self.delta = delta
+        self.limit = limit
+        self._times = deque()
+
+    def wait(self) -> None:
+        now = time.monotonic()
+        times = self._times
+        while times and now - times[0] >= self.delta:
+            times.popleft()
+        if len(times) >= self.limit:
+            time.sleep(self.delta - (now - times[0]))
+            times.popleft()
+
+    def mark(self) -> None:
+        self._times.append(time.monotonic())
+
+class SMTPPool:
+    """One persistent SMTP session reused for a batch of sends.
+
+    Reconnects after max_messages (provider per-connection cap) and allows at
+    most rate_limit messages in any rate_delta-second window.
+    """
+
+    def __init__(self, smtp_server: str, smtp_port: int, username: str, password: str,
+                 max_messages: int = 500, rate_delta: float = 5, rate_limit: int = 1,
+                 rate_gate: "RateGate | None" = None):
+        self.smtp_server = smtp_server
+        self.smtp_port = smtp_port
+        self.username = username
+        self.password = password
+        self.max_messages = max_messages
+        # Pass a shared gate to pace sends across pools; otherwise each pool paces itself
+        self.rate_gate = rate_gate or RateGate(rate_delta, rate_limit)
+        self.server = None
+        self.messages_sent = 0
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc):
+        self.close()
+
+    def _connect(self):
+        # Only keep the session once login succeeds, so a failed handshake is retried
+        server = smtplib.SMTP(self.smtp_server, self.smtp_port)
+        try:
+            server.ehlo()
+            server.starttls()
+            server.ehlo()
+            server.login(self.username, self.password)
+        except Exception:
+            server.close()
+            raise
+        self.server = server
+        self.messages_sent = 0
+
+    def close(self):
+        if self.server is not None:
+            try:
+                self.server.quit()
+            except (smtplib.SMTPException, OSError):
+                pass
+            finally:
+                self.server = None
+
+    def send(self, from_email: str, to_email: str, msg) -> None:
+        if self.server is None or self.messages_sent >= self.max_messages:
+            self.close()
+            self._connect()
+        self.rate_gate.wait()
+        try:
+            self.server.sendmail(from_email, to_email, msg.as_string())
+        except smtplib.SMTPServerDisconnected:
+            self.server = None
+            raise
+        finally:
+            self.rate_gate.mark()
+        self.messages_sent += 1
+
+def send_with_pool(pool: SMTPPool, to_email: str, subject: str, body_html: str, from_email: str) -> str:
     try:
         msg = MIMEMultipart("alternative")
         msg['From'] = from_email
@@ -117,12 +419,8 @@ def send_email(to_email: str, subject: str, body_html: str, from_email: str,
         msg['Subject'] = subject
         msg.attach(MIMEText(body_html, 'html'))
 
-        server = smtplib.SMTP(smtp_server, smtp_port)
-        server.starttls()
-        server.login(username, password)
-        server.sendmail(from_email, to_email, msg.as_string())
-        server.quit()
-        
+        pool.send(from_email, to_email, msg)
+
         log_action("EMAIL SENT", f"To: {to_email}")
         return f"✅ Sent to {to_email}"
     except Exception as e:
@@ -130,26 +428,130 @@ def send_email(to_email: str, subject: str, body_html: str, from_email: str,
         log_action("EMAIL FAILED", error_msg)
         return error_msg
 
-def calculate_priority(description: str) -> int:
-    score = 0
-    keywords_high = ["hepatitis b", "hbv", "liver", "transplant", "nigeria", "africa", "grant", "sponsor"]
-    keywords_medium = ["medical", "health", "christian", "charity", "donation", "ngo"]
-    desc = description.lower()
-    for kw in keywords_high:
-        if kw in desc: score += 20
-    for kw in keywords_medium:
-        if kw in desc: score += 8
-    return min(score, 100)
+# The agent tool opens a pool per call, so it shares one gate (kept across
+# Streamlit reruns) to keep its 5 s spacing between consecutive sends
+@st.cache_resource
+def _send_email_rate_gate() -> RateGate:
+    return RateGate(5, 1)
+
+def send_email(to_email: str, subject: str, body_html: str, from_email: str,
+               smtp_server: str, smtp_port: int, username: str, password: str) -> str:
+    with SMTPPool(smtp_server, smtp_port, username, password, rate_gate=_send_email_rate_gate()) as pool:
+        return send_with_pool(pool, to_email, subject, body_html, from_email)
+
+SMTP_CONCURRENCY = 4
+
+def send_batch(recipients, subject: str, from_email: str, password: str,
+               completed: queue.Queue, smtp_server: str = "smtp.gmail.com", smtp_port: int = 587,
+               concurrency: int = SMTP_CONCURRENCY):
+    """Send (sponsor_id, to_email, body_html) recipients over up to `concurrency`
+    SMTP sessions, one SMTPPool per worker thread.
+
+    Yields (sponsor_id, to_email, status) as each send completes. Each worker
+    also puts (sponsor_id, to_email, status, sent_date) on `completed` itself,
+    so sends still in flight when the caller stops consuming are not lost;
+    close() the generator to wait for them.
+    """
+    local = threading.local()
+    pools = []
+
+    def send_one(sponsor_id, to_email, body_html):
+        pool = getattr(local, "pool", None)
+        if pool is None:
+            pool = local.pool = SMTPPool(smtp_server, smtp_port, from_email, password)
+            pools.append(pool)
+        status = send_with_pool(pool, to_email, subject, body_html, from_email)
+        completed.put((sponsor_id, to_email, status, datetime.now().strftime("%Y-%m-%d %H:%M")))
+        return sponsor_id, to_email, status
+
+    executor = ThreadPoolExecutor(max_workers=concurrency)
+    try:
+        futures = [executor.submit(send_one, *r) for r in recipients]
+        for future in as_completed(futures):
+            yield future.result()
+    finally:
+        executor.shutdown(wait=True, cancel_futures=True)
+        for pool in pools:
+            pool.close()
+
+def recompute_priorities() -> int:
+    # Score inside SQLite's own row loop instead of round-tripping each row through Python
+    conn = connect_db()
+    with conn:
+        updated = conn.execute("UPDATE sponsors SET priority = calc_priority(COALESCE(description, ''))").rowcount
+    conn.close()
+    log_action("PRIORITIES RECOMPUTED", f"{updated} sponsors")
+    return updated
+
+EMAIL_RE = re.compile(r"[^@\s]+@[^@\s]+\.[^@\s]+")
+MIN_SAVE_PRIORITY = 30  # only sponsors scoring above this are worth keeping
+
+def save_sponsor(name: str, email: str, description: str, source: str) -> str:
+    name = (name or "").strip()
+    email = (email or "").strip().lower() or None
+    if email is not None and not EMAIL_RE.fullmatch(email):
+        return f"Not saved: invalid email {email!r}"
+    if email is None and not name:
+        return "Not saved: a sponsor needs a name or an email"
+    score = calculate_priority(description or "")
+    if score <= MIN_SAVE_PRIORITY:
+        return f"Not saved: {name} scores {score}, needs more than {MIN_SAVE_PRIORITY}"
+    # Email is the key when present; email-less sponsors are keyed on lower(name)
+    # via the idx_sponsors_name_no_email partial unique index
+    if email is not None:
+        conflict_target = "(email)"
+        lookup = ("SELECT priority FROM sponsors WHERE email = ?", (email,))
+    else:
+        conflict_target = "(lower(name)) WHERE email IS NULL"
+        lookup = ("SELECT priority FROM sponsors WHERE email IS NULL AND lower(name) = lower(?)", (name,))
+    conn = connect_db()
+    with conn:
+        # Priority comes from the trigger; on a duplicate, only take the new
+        # description if it scores at least as well, so the better priority wins
+        cur = conn.execute(f"""
+            INSERT INTO sponsors (name, email, description, source, added_date)
+            VALUES (?, ?, ?, ?, ?)
+            ON CONFLICT{conflict_target} DO UPDATE SET description = excluded.description
+            WHERE calc_priority(COALESCE(excluded.description, '')) >= sponsors.priority
+        """, (name, email, description, source, datetime.now().strftime("%Y-%m-%d %H:%M")))
+        priority = conn.execute(*lookup).fetchone()[0]
+    conn.close()
+    contact = f"{name} <{email or 'no email'}>"
+    if cur.rowcount == 0:
+        # Conflict update skipped: the stored description already scores higher
+        return f"Already saved {contact}; kept existing entry (priority {priority})"
+    log_action("SPONSOR SAVED", f"{contact} priority={priority}")
+    return f"Saved {contact} (priority {priority})"
+
+def exists_sponsor(name: str, email: str = "") -> bool:
+    email = (email or "").strip().lower()
+    conn = sqlite3.connect(DB_FILE)
+    if email:
+        row = conn.execute("SELECT 1 FROM sponsors WHERE email = ?", (email,)).fetchone()
+    else:
+        row = conn.execute("SELECT 1 FROM sponsors WHERE email IS NULL AND lower(name) = lower(?)",
+                           ((name or "").strip(),)).fetchone()
+    conn.close()
+    return row is not None
+
+def search_sponsors(match_query: str) -> list:
+    # FTS5 MATCH syntax, e.g. 'hepatitis AND (grant OR charity)'
+    conn = sqlite3.connect(DB_FILE)
+    ids = [row[0] for row in conn.execute(
+        "SELECT rowid FROM sponsors_fts WHERE sponsors_fts MATCH ? ORDER BY rank", (match_query,))]
+    conn.close()
+    return ids
 
-# ====================== AUTOGEN SETUP (Correct for 0.7.5) ======================
-from autogen_agentchat.agents import AssistantAgent, UserProxyAgent
-from autogen_agentchat.teams import RoundRobinGroupChat, GroupChatManager
-from autogen_agentchat import register_function
+# ====================== AUTOGEN SETUP (pyautogen) ======================
+from autogen import AssistantAgent, UserProxyAgent, GroupChat, GroupChatManager, register_function
+from openai import OpenAI
 
 llm_config = {
     "config_list": [{"model": "gpt-4o-mini", "api_key": os.getenv("OPENAI_API_KEY")}],
     "temperature": 0.7,
 }
+# Extraction and send prep are deterministic tasks; low temperature cuts retries
+precise_llm_config = {**llm_config, "temperature": 0.2}
 
 user_proxy = UserProxyAgent(
     name="UserProxy",
@@ -161,15 +563,16 @@ user_proxy = UserProxyAgent(
 researcher = AssistantAgent(
     name="Researcher",
     llm_config=llm_config,
-    system_message="Search the web deeply for organizations, churches, NGOs, individuals, or grants that help with Hepatitis B treatment, tests, travel, or transplants — especially in Nigeria/Africa or faith-based groups. Use web_search tool."
+    system_message="Search the web deeply for organizations, churches, NGOs, individuals, or grants that help with Hepatitis B treatment, tests, travel, or transplants — especially in Nigeria/Africa or faith-based groups. Split the research into 3-5 focused sub-queries and run them together in one web_search_multi call; use web_search for a single follow-up query."
 )
 
 analyzer = AssistantAgent(
     name="Analyzer",
-    llm_config=llm_config,
+    llm_config=precise_llm_config,
     system_message="""Analyze search results. Extract sponsor name, email (if present), description, source.
-    Calculate priority score (0-100) using calculate_priority function.
-    Save promising ones (priority > 30) to database. NEVER send emails automatically."""
+    Call exists_sponsor (name, and email if any) first and skip sponsors that are already saved.
+    Pass each remaining sponsor to save_sponsor; it scores the description (0-100) and
+    only keeps sponsors scoring above 30. NEVER send emails automatically."""
 )
 
 outreach_writer = AssistantAgent(
@@ -180,17 +583,113 @@ outreach_writer = AssistantAgent(
 
 email_sender = AssistantAgent(
     name="EmailSender",
-    llm_config=llm_config,
+    llm_config=precise_llm_config,
     system_message="Only prepare emails for sending. Do NOT send unless human approves via app button."
 )
 
 register_function(web_search, caller=researcher, executor=user_proxy, name="web_search")
+register_function(web_search_multi, caller=researcher, executor=user_proxy, name="web_search_multi")
+register_function(exists_sponsor, caller=analyzer, executor=user_proxy, name="exists_sponsor")
+register_function(save_sponsor, caller=analyzer, executor=user_proxy, name="save_sponsor")
 register_function(send_email, caller=email_sender, executor=user_proxy, name="send_email")
 
-# Use RoundRobinGroupChat (works in current version)
-group_chat = RoundRobinGroupChat(
+# ====================== CONTEXT COMPRESSION ======================
+COMPRESS_TOKEN_THRESHOLD = 6000
+# Kept byte-identical across calls so the provider can reuse the cached prefix
+SUMMARY_SYSTEM_PROMPT = (
+    "You compress a multi-agent research conversation about Hepatitis B sponsors. "
+    "Keep every organization name, email, link, priority score and decision. "
+    "Drop pleasantries and repeated search output. Reply with the summary only."
+)
+
+class ContextCompressor:
+    """Folds all but the last few messages of the chat history into a running
+    [SUMMARY] message once the history grows past token_threshold.
+
+    One instance is shared by every agent: the group chat broadcasts the same
+    messages in the same order to each of them, so folding by position lets
+    a summary produced for one agent be reused by the others.
+    """
+
+    def __init__(self, model_config: dict, keep_last: int = 3,
+                 token_threshold: int = COMPRESS_TOKEN_THRESHOLD):
+        self.model_config = model_config
+        self.keep_last = keep_last
+        self.token_threshold = token_threshold
+        self.summary = ""
+        self.folded = 0
+        self._first = None
+        self._client = None
+
+    @staticmethod
+    def _tokens(messages) -> int:
+        # ~4 characters per token is close enough for a threshold check
+        return sum(len(str(m.get("content") or "")) for m in messages) // 4
+
+    def _summarize(self, messages) -> str:
+        if self._client is None:
+            self._client = OpenAI(api_key=self.model_config.get("api_key"),
+                                  base_url=self.model_config.get("base_url"))
+        transcript = "\n".join(f"{m.get('name') or m.get('role')}: {m.get('content') or ''}" for m in messages)
+        previous = f"Previous summary:\n{self.summary}\n\n" if self.summary else ""
+        response = self._client.chat.completions.create(
+            model=self.model_config["model"],
+            temperature=0,
+            messages=[
+                {"role": "system", "content": SUMMARY_SYSTEM_PROMPT},
+                {"role": "user", "content": previous + "New messages:\n" + transcript},
+            ],
+        )
+        return response.choices[0].message.content
+
+    def __call__(self, messages):
+        if not messages:
+            return messages
+        first = messages[0].get("content")
+        if first != self._first or len(messages) < self.folded:  # new conversation
+            self._first = first
+            self.summary = ""
+            self.folded = 0
+        if self._tokens(messages[self.folded:]) <= self.token_threshold:
+            return self._with_summary(messages)
+        cut = max(len(messages) - self.keep_last, 0)
+        # Never separate tool results from the assistant message that requested them
+        while cut > 0 and messages[cut].get("role") == "tool":
+            cut -= 1
+        if cut > self.folded:
+            try:
+                self.summary = self._summarize(messages[self.folded:cut])
+                self.folded = cut
+            except Exception as e:
+                log_action("CONTEXT COMPRESSION FAILED", str(e))
+        return self._with_summary(messages)
+
+    def _with_summary(self, messages):
+        if not self.summary:
+            return messages
+        return [{"role": "system", "content": "[SUMMARY] " + self.summary}] + messages[self.folded:]
+
+context_compressor = ContextCompressor(llm_config["config_list"][0])
+for agent in (researcher, analyzer, outreach_writer, email_sender):
+    agent.register_hook("process_all_messages_before_reply", context_compressor)
+
+# Handoff graph: each agent only passes to the next stage or to UserProxy
+# (which executes tool calls). Turns with a single allowed successor skip the
+# manager's speaker-selection LLM call entirely.
+allowed_transitions = {
+    user_proxy: [researcher, analyzer, email_sender],
+    researcher: [user_proxy, analyzer],
+    analyzer: [user_proxy, outreach_writer],
+    outreach_writer: [email_sender],
+    email_sender: [user_proxy],
+}
+
+group_chat = GroupChat(
     agents=[user_proxy, researcher, analyzer, outreach_writer, email_sender],
-    max_round=15,
+    messages=[],
+    allowed_or_disallowed_speaker_transitions=allowed_transitions,
+    speaker_transitions_type="allowed",
+    max_round=10,
 )
 
 manager = GroupChatManager(
@@ -225,10 +724,16 @@ with tab1:
 
 with tab2:
     st.write("### Found Sponsors (auto-saved)")
-    conn = sqlite3.connect(DB_FILE)
-    df = pd.read_sql_query("SELECT * FROM sponsors ORDER BY priority DESC", conn)
-    conn.close()
+    if st.button("Recalculate priorities"):
+        st.success(f"Re-scored {recompute_priorities()} sponsors")
+    df = load_sponsors(db_signature())
     if not df.empty:
+        keywords = st.text_input("Filter by description keywords", placeholder="e.g. hepatitis AND (grant OR charity)")
+        if keywords.strip():
+            try:
+                df = df[df["id"].isin(search_sponsors(keywords))]
+            except sqlite3.OperationalError as e:
+                st.warning(f"Invalid filter: {e}")
         st.dataframe(df, use_container_width=True)
         csv = df.to_csv(index=False).encode()
         st.download_button("Download as CSV", csv, "hbv_sponsors.csv", "text/csv")
@@ -237,15 +742,7 @@ with tab2:
 
 with tab3:
     st.write("### Send Outreach Emails (You control this)")
-    conn = sqlite3.connect(DB_FILE)
-    pending = pd.read_sql_query("""
-        SELECT s.id, s.name, s.email, s.priority 
-        FROM sponsors s 
-        LEFT JOIN outreach o ON s.id = o.sponsor_id 
-        WHERE o.id IS NULL AND s.email IS NOT NULL AND s.email LIKE '%@%'
-        ORDER BY s.priority DESC
-    """, conn)
-    conn.close()
+    pending = load_pending(db_signature())
 
     if not pending.empty:
         st.dataframe(pending)
@@ -261,25 +758,39 @@ with tab3:
                         st.error("Set email credentials in sidebar first")
                     else:
                         results = []
-                        for _, row in pending.iterrows():
-                            personalized_html = HTML_TEMPLATE.format(recipient_name_or_team=row["name"] or "Team")
-                            status = send_email(
-                                to_email=row["email"],
+                        outreach_rows = []
+                        conn = connect_db(isolation_level=None)
+                        cur = conn.cursor()
+                        completed = queue.Queue()
+                        batch = None
+                        try:
+                            # Plain cursor rows for the send loop; the DataFrame above is display-only
+                            recipients = (
+                                (sponsor_id, email, _TEMPLATE_HEAD + (name or "Team") + _TEMPLATE_TAIL)
+                                for sponsor_id, name, email, _ in conn.execute(PENDING_SQL)
+                            )
+                            batch = send_batch(
+                                recipients,
                                 subject="Request for Support – Chronic Hepatitis B (Nigeria)",
-                                body_html=personalized_html,
                                 from_email=from_email,
-                                smtp_server="smtp.gmail.com",
-                                smtp_port=587,
-                                username=from_email,
-                                password=password
+                                password=password,
+                                completed=completed,
                             )
-                            # Log to DB
-                            c = sqlite3.connect(DB_FILE)
-                            c.execute("INSERT INTO outreach (sponsor_id, sent_date, status, message) VALUES (?, ?, ?, ?)",
-                                      (row["id"], datetime.now().strftime("%Y-%m-%d %H:%M"), status, "HTML template"))
-                            c.commit()
-                            c.close()
-                            results.append(f"{row['email']} → {status}")
+                            for sponsor_id, to_email, status in batch:
+                                results.append(f"{to_email} → {status}")
+                                outreach_rows.extend(drain_outreach(completed))
+                                if len(outreach_rows) >= OUTREACH_FLUSH_EVERY:
+                                    flush_outreach(cur, outreach_rows)
+                        finally:
+                            # Wait for in-flight sends, then log everything sent to DB,
+                            # even if the batch was interrupted
+                            try:
+                                if batch is not None:
+                                    batch.close()
+                                outreach_rows.extend(drain_outreach(completed))
+                                flush_outreach(cur, outreach_rows)
+                            finally:
+                                conn.close()
                         st.success("All emails processed!")
                         for r in results:
                             st.write(r)
@@ -289,8 +800,7 @@ with tab3:
 with tab4:
     st.write("### Recent Log")
     try:
-        with open("hbv_outreach.log", "r") as f:
-            logs = f.read().splitlines()[-50:]
+        logs = load_log_tail(file_signature(LOG_FILE))
         st.code("\n".join(logs[::-1]))
     except:
         st.write("No log yet")